@@ -1,11 +1,12 @@
+import io
 import json
 import os
 import subprocess
 import tarfile
 import tempfile
 import uuid
-from typing import (IO, AnyStr, BinaryIO, Iterator, List, Mapping, NoReturn, Optional, Sequence,
-                    Union)
+from typing import (IO, Any, AnyStr, BinaryIO, Dict, Iterator, List, Mapping, NoReturn, Optional,
+                    Sequence, Union)
 
 SANDBOX_HOME_DIR_NAME = '/home/autograder'
 SANDBOX_WORKING_DIR_NAME = os.path.join(SANDBOX_HOME_DIR_NAME, 'working_dir')
@@ -50,7 +51,8 @@ class AutograderSandbox:
                  pids_limit: int = SANDBOX_PIDS_LIMIT,
                  memory_limit: str = SANDBOX_MEM_LIMIT,
                  min_fallback_timeout: int = SANDBOX_MIN_FALLBACK_TIMEOUT,
-                 debug: bool = False):
+                 debug: bool = False,
+                 fast_teardown: bool = False):
         """
         :param name: A human-readable name that can be used to identify
             this sandbox instance. This value must be unique across all
@@ -124,6 +126,13 @@ class AutograderSandbox:
             setting the SANDBOX_MIN_FALLBACK_TIMEOUT environment variable.
 
         :param debug: Whether to print additional debugging information.
+
+        :param fast_teardown: When True, the underlying container is
+            killed and removed with "docker rm --force" when the sandbox
+            is destroyed (on exiting the context manager or in reset()),
+            instead of being stopped with "docker stop" first. This skips
+            the stop's grace period (about 1 second), but processes in the
+            sandbox are sent SIGKILL without first receiving SIGTERM.
         """
         if name is None:
             self._name = 'sandbox-{}'.format(uuid.uuid4().hex)
@@ -139,6 +148,7 @@ class AutograderSandbox:
         self._memory_limit = memory_limit
         self._min_fallback_timeout = min_fallback_timeout
         self.debug = debug
+        self._fast_teardown = fast_teardown
 
     def __enter__(self) -> 'AutograderSandbox':
         self._create_and_start()
@@ -219,8 +229,11 @@ class AutograderSandbox:
         self._is_running = True
 
     def _destroy(self) -> None:
-        self._stop()
-        subprocess.check_call(['docker', 'rm', self.name])
+        if self._fast_teardown:
+            subprocess.check_call(['docker', 'rm', '--force', self.name])
+        else:
+            self._stop()
+            subprocess.check_call(['docker', 'rm', self.name])
         self._is_running = False
 
     def _stop(self) -> None:
@@ -301,7 +314,9 @@ class AutograderSandbox:
 
         :param stdin: A file object to be redirected as input to the
             command's stdin. If this is None, /dev/null is sent to the
-            command's stdin.
+            command's stdin. File objects that aren't backed by a file
+            descriptor (e.g. io.BytesIO) are read into memory and
+            written to the command's stdin through a pipe.
 
         :param timeout: The time limit for the command.
 
@@ -345,12 +360,20 @@ class AutograderSandbox:
         if self.debug:
             print('running: {}'.format(cmd), flush=True)
 
+        stdin_kwargs: Dict[str, Any] = {}
+        if stdin is not None and _has_fileno(stdin):
+            stdin_kwargs['stdin'] = stdin
+        elif stdin is not None:
+            stdin_data = stdin.read()
+            stdin_kwargs['input'] = (
+                stdin_data.encode() if isinstance(stdin_data, str) else stdin_data)
+
         with tempfile.TemporaryFile() as runner_stdout, tempfile.TemporaryFile() as runner_stderr:
             fallback_timeout = (
                 max(timeout * 2, self._min_fallback_timeout) if timeout is not None else None)
             try:
-                subprocess.run(cmd, stdin=stdin, stdout=runner_stdout, stderr=runner_stderr,
-                               check=True, timeout=fallback_timeout)
+                subprocess.run(cmd, stdout=runner_stdout, stderr=runner_stderr,
+                               check=True, timeout=fallback_timeout, **stdin_kwargs)
                 runner_stdout.seek(0)
 
                 json_len = int(runner_stdout.readline().decode().rstrip())
@@ -492,7 +515,7 @@ class AutograderSandbox:
 def _chunked_read(
     file_obj: IO[bytes],
     amount_to_read: int,
-    chunk_size: int = 1024 * 16
+    chunk_size: int = 1024 * 64
 ) -> Iterator[bytes]:
     num_reads = amount_to_read // chunk_size
     for i in range(num_reads):
@@ -529,3 +552,51 @@ class CompletedCommand:
         self.timed_out = timed_out
         self.stdout_truncated = stdout_truncated
         self.stderr_truncated = stderr_truncated
+
+        self._text_stdout: Optional[str] = None
+        self._text_stderr: Optional[str] = None
+
+    @property
+    def text_stdout(self) -> str:
+        """
+        The stdout content of the command, decoded as UTF-8 (invalid
+        bytes are replaced). stdout is read from the beginning the
+        first time this is accessed, and the result is cached. The
+        position of the stdout file object is left unchanged.
+        """
+        if self._text_stdout is None:
+            self._text_stdout = _read_text(self.stdout)
+        return self._text_stdout
+
+    @property
+    def text_stderr(self) -> str:
+        """
+        The stderr content of the command, decoded as UTF-8 (invalid
+        bytes are replaced). stderr is read from the beginning the
+        first time this is accessed, and the result is cached. The
+        position of the stderr file object is left unchanged.
+        """
+        if self._text_stderr is None:
+            self._text_stderr = _read_text(self.stderr)
+        return self._text_stderr
+
+
+# Reads and decodes the entire contents of file_obj, restoring its
+# original position afterwards.
+def _read_text(file_obj: IO[bytes]) -> str:
+    original_position = file_obj.tell()
+    try:
+        file_obj.seek(0)
+        return file_obj.read().decode(errors='replace')
+    finally:
+        file_obj.seek(original_position)
+
+
+# Returns True if file_obj is backed by a file descriptor, which
+# subprocess needs in order to redirect a child's stdin from it.
+def _has_fileno(file_obj: IO[AnyStr]) -> bool:
+    try:
+        file_obj.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return False
+    return True
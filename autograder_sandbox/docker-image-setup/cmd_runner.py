@@ -1,16 +1,16 @@
-#! /usr/bin/python3
+#! /usr/bin/python3 -S
 
 import os
 import sys
 import subprocess
 import signal
+import select
+import time
 import pwd
-import argparse
 import resource
 import json
 import tempfile
-import uuid
-import shutil
+import types
 import grp
 
 
@@ -57,6 +57,11 @@ def main():
     # so that we can determine output size with os.path.size(). In some cases,
     # notably when valgrind produces a core dump, file.tell() produces a value
     # that is too large, which then causes an error.
+    # Note that we deliberately leave these files in the default temp
+    # directory instead of on /dev/shm (or in a memfd). Docker limits
+    # /dev/shm to 64MB by default, and RAM-backed files count towards the
+    # container's memory limit (which has the OOM killer disabled), but the
+    # full output is written here regardless of truncate_stdout/stderr.
     with tempfile.NamedTemporaryFile() as stdout, tempfile.NamedTemporaryFile() as stderr:
         # Adopted from https://github.com/python/cpython/blob/3.5/Lib/subprocess.py#L378
         env_copy = os.environ.copy()
@@ -74,15 +79,17 @@ def main():
                                   start_new_session=True,
                                   env=env_copy) as process:
                 try:
-                    process.communicate(None, timeout=args.timeout)
+                    _wait_for_process(process, args.timeout)
                     return_code = process.poll()
                 except subprocess.TimeoutExpired:
                     # http://stackoverflow.com/questions/4789837/how-to-terminate-a-python-subprocess-launched-with-shell-true
-                    os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+                    # Since start_new_session=True, the command is the leader
+                    # of its own process group, whose ID is the command's pid.
+                    os.killpg(process.pid, signal.SIGKILL)
                     process.wait()
                     timed_out = True
                 except:  # noqa
-                    os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+                    os.killpg(process.pid, signal.SIGKILL)
                     process.wait()
                     raise
 
@@ -105,26 +112,74 @@ def main():
             'stderr_truncated': stderr_truncated,
         }
 
-        json_data = json.dumps(results)
-        print(len(json_data), flush=True)
-        print(json_data, end='', flush=True)
+        # The host reads this output from a file after we exit, so we write
+        # the length-prefixed fields straight to the binary buffer and
+        # flush once at the end.
+        output = sys.stdout.buffer
+        json_data = json.dumps(results).encode()
+        output.write('{}\n'.format(len(json_data)).encode() + json_data)
 
         truncated_stdout_len = args.truncate_stdout if stdout_truncated else stdout_len
-        print(truncated_stdout_len, flush=True)
-        stdout.seek(0)
-        for chunk in _chunked_read(stdout, truncated_stdout_len):
-            sys.stdout.buffer.write(chunk)
-            sys.stdout.flush()
+        output.write('{}\n'.format(truncated_stdout_len).encode())
+        if truncated_stdout_len:
+            stdout.seek(0)
+            for chunk in _chunked_read(stdout, truncated_stdout_len):
+                output.write(chunk)
 
         truncated_stderr_len = args.truncate_stderr if stderr_truncated else stderr_len
-        print(stderr_len, flush=True)
-        stderr.seek(0)
-        for chunk in _chunked_read(stderr, truncated_stderr_len):
-            sys.stdout.buffer.write(chunk)
-            sys.stdout.flush()
+        output.write('{}\n'.format(truncated_stderr_len).encode())
+        if truncated_stderr_len:
+            stderr.seek(0)
+            for chunk in _chunked_read(stderr, truncated_stderr_len):
+                output.write(chunk)
+        output.flush()
 
 
-def parse_args():
+_INT_FLAGS = (
+    '--timeout',
+    '--max_stack_size',
+    '--max_virtual_memory',
+    '--truncate_stdout',
+    '--truncate_stderr',
+)
+_BOOL_FLAGS = (
+    '--block_process_spawn',
+    '--as_root',
+    '--stdin_devnull',
+)
+
+
+# This is equivalent to the argparse parser in _parse_args_with_argparse,
+# but it avoids importing argparse and building the parser (several
+# milliseconds) for every command. Anything it doesn't recognize, including
+# --help and malformed values, is handed off to argparse so that behavior
+# and error messages are unchanged.
+def parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parsed = {flag[2:]: None for flag in _INT_FLAGS}
+    parsed.update({flag[2:]: False for flag in _BOOL_FLAGS})
+
+    index = 0
+    while index < len(argv) and argv[index].startswith('-'):
+        flag = argv[index]
+        if flag in _BOOL_FLAGS:
+            parsed[flag[2:]] = True
+            index += 1
+        elif flag in _INT_FLAGS and index + 1 < len(argv) and argv[index + 1].isdecimal():
+            parsed[flag[2:]] = int(argv[index + 1])
+            index += 2
+        else:
+            return _parse_args_with_argparse(argv)
+
+    parsed['cmd_args'] = argv[index:]
+    return types.SimpleNamespace(**parsed)
+
+
+def _parse_args_with_argparse(argv):
+    import argparse
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--timeout", type=int)
     parser.add_argument("--block_process_spawn", action='store_true', default=False)
@@ -136,12 +191,73 @@ def parse_args():
     parser.add_argument("--stdin_devnull", action='store_true', default=False)
     parser.add_argument("cmd_args", nargs=argparse.REMAINDER)
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
+
+
+# Waits for process to exit, raising subprocess.TimeoutExpired if it
+# is still running after timeout seconds.
+# Popen.wait() enforces a timeout by polling with an increasing sleep
+# interval, which can add tens of milliseconds to every command. We
+# instead let the kernel wake us up as soon as the process exits: with
+# a pidfd where pidfd_open() is available (Python 3.9+, Linux 5.3+),
+# and with SIGCHLD otherwise.
+def _wait_for_process(process, timeout):
+    if timeout is None:
+        process.wait()
+        return
+
+    pidfd = None
+    if hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except OSError:
+            pass
+
+    if pidfd is None:
+        _wait_for_sigchld(process, timeout)
+        return
+
+    try:
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        if not poller.poll(timeout * 1000):
+            raise subprocess.TimeoutExpired(process.args, timeout)
+    finally:
+        os.close(pidfd)
+
+    process.wait()
+
+
+# Waits for process to exit by waking up on SIGCHLD, raising
+# subprocess.TimeoutExpired if it is still running after timeout
+# seconds. The signal handler only needs to exist: signal.set_wakeup_fd()
+# makes the interpreter write to a pipe, which we select() on, whenever
+# a signal with a Python handler arrives.
+def _wait_for_sigchld(process, timeout):
+    deadline = time.monotonic() + timeout
+    read_fd, write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+    old_handler = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    old_wakeup_fd = signal.set_wakeup_fd(write_fd)
+    try:
+        # The process may have exited before the handler was installed,
+        # so check before waiting for the first signal.
+        while process.poll() is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(process.args, timeout)
+
+            if select.select([read_fd], [], [], remaining)[0]:
+                os.read(read_fd, 512)
+    finally:
+        signal.set_wakeup_fd(old_wakeup_fd)
+        signal.signal(signal.SIGCHLD, old_handler)
+        os.close(read_fd)
+        os.close(write_fd)
 
 
 # Generator that reads amount_to_read bytes from file_obj, yielding
 # one chunk at a time.
-def _chunked_read(file_obj, amount_to_read, chunk_size=1024 * 16):
+def _chunked_read(file_obj, amount_to_read, chunk_size=1024 * 64):
     num_reads = amount_to_read // chunk_size
     for i in range(num_reads):
         yield file_obj.read(chunk_size)
@@ -2,7 +2,7 @@ import argparse
 import os
 import tempfile
 import time
-from typing import Optional
+from typing import List, Optional
 
 from .autograder_sandbox import AutograderSandbox, SandboxCommandError
 
@@ -29,7 +29,7 @@ def output_size_performance_test(
     with AutograderSandbox() as sandbox:
         start = time.time()
         result = sandbox.run_command(
-            ['python3', '-c', _PRINT_PROG.format(output_size, stream='stdout')],
+            _print_cmd(output_size, stream='stdout'),
             truncate_stdout=truncate, truncate_stderr=truncate, check=True)
         print('Ran command that printed {} bytes to stdout in {}'.format(
             output_size, time.time() - start))
@@ -44,7 +44,7 @@ def output_size_performance_test(
         with AutograderSandbox() as sandbox:
             start = time.time()
             result = sandbox.run_command(
-                ['python3', '-c', _PRINT_PROG.format(output_size, stream='stderr')],
+                _print_cmd(output_size, stream='stderr'),
                 truncate_stdout=truncate, truncate_stderr=truncate, check=True)
             print('Ran command that printed {} bytes to stderr in {}'.format(
                 output_size, time.time() - start))
@@ -56,19 +56,13 @@ def output_size_performance_test(
                 assert stderr_size == truncate
 
 
-_PRINT_PROG = """
-import sys
+# Returns a command that prints output_size bytes to the given stream.
+# head reads /dev/zero in large blocks, so the time it takes is small
+# compared to the time the sandbox spends handling the output.
+def _print_cmd(output_size: int, *, stream: str) -> List[str]:
+    redirect = ' >&2' if stream == 'stderr' else ''
+    return ['bash', '-c', 'head -c {} /dev/zero{}'.format(output_size, redirect)]
 
-output_size = {}
-repeat_str = 'a' * 1000
-num_repeats = output_size // 1000
-remainder = output_size % 1000
-for i in range(num_repeats):
-    sys.{stream}.write(repeat_str)
-    sys.{stream}.flush()
-sys.{stream}.write('a' * remainder)
-sys.{stream}.flush()
-"""
 
 if __name__ == '__main__':
     main()
@@ -4,19 +4,20 @@ import unittest
 from unittest import mock
 import subprocess
 import tempfile
-import multiprocessing
-import itertools
-import time
+import threading
+import concurrent.futures
+import functools
+import hashlib
 import uuid
-from typing import IO, Callable, TypeVar, Optional
-
-from collections import OrderedDict
+import weakref
+from typing import Any, Dict, List, Optional
 
 from .autograder_sandbox import (
     AutograderSandbox,
     SandboxCommandError,
     SANDBOX_USERNAME,
     SANDBOX_HOME_DIR_NAME,
+    SANDBOX_WORKING_DIR_NAME,
     SANDBOX_DOCKER_IMAGE,
     CompletedCommand
 )
@@ -24,6 +25,28 @@ from .autograder_sandbox import (
 from .output_size_performance_test import output_size_performance_test
 
 
+# The amount of output printed by the "very large IO" tests.
+# Set the AG_SANDBOX_TEST_IO_BYTES environment variable to test with a
+# larger (e.g. 10**9) or smaller payload.
+_LARGE_IO_TEST_BYTES = int(os.environ.get('AG_SANDBOX_TEST_IO_BYTES', 10 ** 8))
+
+# Input that the truncate_stdout/stderr tests echo back.
+_TRUNCATE_TEST_INPUT = b'a' * 100
+
+# Set the AG_SANDBOX_TEST_DEBUG environment variable to 1 to have the
+# tests print the output of the commands they run.
+_DEBUG = os.environ.get('AG_SANDBOX_TEST_DEBUG') == '1'
+
+# A file that the reset/restart tests add to the sandbox.
+_THIS_FILE = os.path.abspath(__file__)
+_THIS_FILE_BASENAME = os.path.basename(_THIS_FILE)
+
+
+def _debug_print(*values: object) -> None:
+    if _DEBUG:
+        print(*values)
+
+
 def kb_to_bytes(num_kb: int) -> int:
     return 1000 * num_kb
 
@@ -36,11 +59,71 @@ def gb_to_bytes(num_gb: int) -> int:
     return 1000 * mb_to_bytes(num_gb)
 
 
+# A sandbox with the default settings that is shared by every
+# _SharedSandboxTestCase subclass that doesn't customize its sandbox.
+# It is started the first time it's needed and destroyed in tearDownModule.
+_MODULE_SANDBOX: Optional[AutograderSandbox] = None
+
+
+def _get_module_sandbox() -> AutograderSandbox:
+    global _MODULE_SANDBOX
+    if _MODULE_SANDBOX is None:
+        sandbox = AutograderSandbox(fast_teardown=True)
+        sandbox.__enter__()
+        _MODULE_SANDBOX = sandbox
+
+    return _MODULE_SANDBOX
+
+
+def tearDownModule() -> None:
+    global _MODULE_SANDBOX
+    if _MODULE_SANDBOX is not None:
+        _MODULE_SANDBOX.__exit__()
+        _MODULE_SANDBOX = None
+
+
+class _SharedSandboxTestCase(unittest.TestCase):
+    """
+    Base class for test cases whose tests can share a sandbox.
+    Starting a container is far more expensive than running a command in
+    one, so test cases that use the default settings all share one
+    sandbox. Rather than calling sandbox.reset() (which re-creates the
+    container), the working directory is cleared after each test.
+
+    Subclasses can set sandbox_kwargs to customize the sandbox, in which
+    case the sandbox is started once for that class only.
+    """
+    sandbox: AutograderSandbox
+    sandbox_kwargs: Dict[str, Any] = {}
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        if cls.sandbox_kwargs:
+            cls.sandbox = AutograderSandbox(fast_teardown=True, **cls.sandbox_kwargs)
+            cls.sandbox.__enter__()
+        else:
+            cls.sandbox = _get_module_sandbox()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if cls.sandbox_kwargs:
+            cls.sandbox.__exit__()
+        super().tearDownClass()
+
+    def tearDown(self) -> None:
+        self.sandbox.run_command(
+            ['find', SANDBOX_WORKING_DIR_NAME, '-mindepth', '1', '-delete'],
+            as_root=True, check=True)
+        with _PROGS_LOCK:
+            _PROGS_IN_SANDBOX.pop(self.sandbox, None)
+        super().tearDown()
+
+
 class AutograderSandboxInitTestCase(unittest.TestCase):
     def setUp(self) -> None:
         self.name = 'awexome_container{}'.format(uuid.uuid4().hex)
-        self.environment_variables = OrderedDict(
-            {'spam': 'egg', 'sausage': '42'})
+        self.environment_variables = {'spam': 'egg', 'sausage': '42'}
 
     def test_default_init(self) -> None:
         sandbox = AutograderSandbox()
@@ -63,139 +146,136 @@ class AutograderSandboxInitTestCase(unittest.TestCase):
         self.assertEqual(self.environment_variables, sandbox.environment_variables)
 
 
-class AutograderSandboxBasicRunCommandTestCase(unittest.TestCase):
+class AutograderSandboxBasicRunCommandTestCase(_SharedSandboxTestCase):
 
     def setUp(self) -> None:
-        self.sandbox = AutograderSandbox()
-
         self.root_cmd = ["touch", "/"]
 
     def test_run_legal_command_non_root(self) -> None:
         stdout_content = "hello world"
         expected_output = stdout_content.encode() + b'\n'
-        with self.sandbox:
-            cmd_result = self.sandbox.run_command(["echo", stdout_content])
-            self.assertEqual(0, cmd_result.return_code)
-            self.assertEqual(expected_output, cmd_result.stdout.read())
+        cmd_result = self.sandbox.run_command(["echo", stdout_content])
+        self.assertEqual(0, cmd_result.return_code)
+        self.assertEqual(expected_output, cmd_result.stdout.read())
+
+    def test_text_output(self) -> None:
+        cmd_result = self.sandbox.run_command(
+            ['bash', '-c', 'printf "spam\\xff"; printf "egg" >&2'])
+        # The text properties read from the beginning of the output and
+        # leave the file position unchanged.
+        self.assertEqual(b'sp', cmd_result.stdout.read(2))
+        self.assertEqual('spam\ufffd', cmd_result.text_stdout)
+        self.assertEqual(b'am\xff', cmd_result.stdout.read())
+        self.assertEqual('egg', cmd_result.text_stderr)
+        self.assertEqual(b'egg', cmd_result.stderr.read())
+        self.assertIs(cmd_result.text_stdout, cmd_result.text_stdout)
 
     def test_run_illegal_command_non_root(self) -> None:
-        with self.sandbox:
-            cmd_result = self.sandbox.run_command(self.root_cmd)
-            self.assertNotEqual(0, cmd_result.return_code)
-            self.assertNotEqual("", cmd_result.stderr)
+        cmd_result = self.sandbox.run_command(self.root_cmd)
+        self.assertNotEqual(0, cmd_result.return_code)
+        self.assertNotEqual("", cmd_result.stderr)
 
     def test_run_command_as_root(self) -> None:
-        with self.sandbox:
-            cmd_result = self.sandbox.run_command(self.root_cmd, as_root=True)
-            self.assertEqual(0, cmd_result.return_code)
-            self.assertEqual(b"", cmd_result.stderr.read())
+        cmd_result = self.sandbox.run_command(self.root_cmd, as_root=True)
+        self.assertEqual(0, cmd_result.return_code)
+        self.assertEqual(b"", cmd_result.stderr.read())
 
     def test_run_command_raise_on_error(self) -> None:
         """
         Tests that an exception is thrown only when check is True
         and the command exits with nonzero status.
         """
-        with self.sandbox:
-            # No exception should be raised.
-            cmd_result = self.sandbox.run_command(self.root_cmd, as_root=True, check=True)
-            self.assertEqual(0, cmd_result.return_code)
+        # No exception should be raised.
+        cmd_result = self.sandbox.run_command(self.root_cmd, as_root=True, check=True)
+        self.assertEqual(0, cmd_result.return_code)
 
-            with self.assertRaises(SandboxCommandError):
-                self.sandbox.run_command(self.root_cmd, check=True)
+        with self.assertRaises(SandboxCommandError):
+            self.sandbox.run_command(self.root_cmd, check=True)
 
     def test_run_command_executable_does_not_exist_no_error(self) -> None:
-        with self.sandbox:
-            cmd_result = self.sandbox.run_command(['not_an_exe'])
-            self.assertNotEqual(0, cmd_result.return_code)
+        cmd_result = self.sandbox.run_command(['not_an_exe'])
+        self.assertNotEqual(0, cmd_result.return_code)
 
 
-class AutograderSandboxMiscTestCase(unittest.TestCase):
+class AutograderSandboxMiscTestCase(_SharedSandboxTestCase):
 
     def setUp(self) -> None:
-        self.name = 'awexome_container{}'.format(uuid.uuid4().hex)
-        self.environment_variables = OrderedDict(
-            {'spam': 'egg', 'sausage': '42'})
-
-        self.stdin = tempfile.NamedTemporaryFile()
-        self.stdout = tempfile.NamedTemporaryFile()
-        self.stderr = tempfile.NamedTemporaryFile()
-
-    def tearDown(self) -> None:
-        self.stdin.close()
-        self.stdout.close()
-        self.stderr.close()
-
-    def _write_and_seek(self, file_obj: IO[bytes], content: bytes) -> None:
-        file_obj.write(content)
-        file_obj.seek(0)
+        super().setUp()
+        self.environment_variables = {'spam': 'egg', 'sausage': '42'}
 
     def test_very_large_io_no_truncate(self) -> None:
-        output_size_performance_test(10 ** 9)
+        output_size_performance_test(_LARGE_IO_TEST_BYTES)
 
     def test_truncate_very_large_io(self) -> None:
-        output_size_performance_test(10 ** 9, truncate=10**7)
+        output_size_performance_test(_LARGE_IO_TEST_BYTES, truncate=10**7)
 
     def test_truncate_stdout(self) -> None:
         truncate_length = 9
-        long_output = b'a' * 100
-        expected_output = long_output[:truncate_length]
-        self._write_and_seek(self.stdin, long_output)
-        with AutograderSandbox() as sandbox:
-            result = sandbox.run_command(
-                ['cat'], stdin=self.stdin, truncate_stdout=truncate_length)
-            self.assertEqual(expected_output, result.stdout.read())
-            self.assertTrue(result.stdout_truncated)
-            self.assertFalse(result.stderr_truncated)
+        expected_output = _TRUNCATE_TEST_INPUT[:truncate_length]
+        result = self.sandbox.run_command(
+            ['cat'], stdin=io.BytesIO(_TRUNCATE_TEST_INPUT), truncate_stdout=truncate_length)
+        # Read one byte past the limit so that extra output still fails.
+        self.assertEqual(
+            expected_output, result.stdout.read(truncate_length + 1))
+        self.assertTrue(result.stdout_truncated)
+        self.assertFalse(result.stderr_truncated)
 
     def test_truncate_stderr(self) -> None:
         truncate_length = 13
-        long_output = b'a' * 100
-        expected_output = long_output[:truncate_length]
-        self._write_and_seek(self.stdin, long_output)
-        with AutograderSandbox() as sandbox:
-            result = sandbox.run_command(
-                ['bash', '-c', '>&2 cat'], stdin=self.stdin, truncate_stderr=truncate_length)
-            self.assertEqual(expected_output, result.stderr.read())
-            self.assertTrue(result.stderr_truncated)
-            self.assertFalse(result.stdout_truncated)
+        expected_output = _TRUNCATE_TEST_INPUT[:truncate_length]
+        result = self.sandbox.run_command(
+            ['bash', '-c', '>&2 cat'], stdin=io.BytesIO(_TRUNCATE_TEST_INPUT),
+            truncate_stderr=truncate_length)
+        # Read one byte past the limit so that extra output still fails.
+        self.assertEqual(
+            expected_output, result.stderr.read(truncate_length + 1))
+        self.assertTrue(result.stderr_truncated)
+        self.assertFalse(result.stdout_truncated)
 
     def test_run_command_with_input(self) -> None:
         expected_stdout = b'spam egg sausage spam'
-        self._write_and_seek(self.stdin, expected_stdout)
-        with AutograderSandbox() as sandbox:
-            result = sandbox.run_command(['cat'], stdin=self.stdin)
-            self.assertEqual(expected_stdout, result.stdout.read())
+        with tempfile.TemporaryFile() as stdin:
+            stdin.write(expected_stdout)
+            stdin.seek(0)
+            result = self.sandbox.run_command(['cat'], stdin=stdin)
+        self.assertEqual(expected_stdout, result.stdout.read())
+
+    def test_run_command_with_in_memory_input(self) -> None:
+        expected_stdout = b'spam egg sausage spam'
+        result = self.sandbox.run_command(['cat'], stdin=io.BytesIO(expected_stdout))
+        self.assertEqual(expected_stdout, result.stdout.read())
 
     def test_command_tries_to_read_from_stdin_when_stdin_arg_is_none(self) -> None:
-        with AutograderSandbox() as sandbox:
-            result = sandbox.run_command(
-                ['python3', '-c', "import sys; sys.stdin.read(); print('done')"],
-                max_stack_size=10000000,
-                max_virtual_memory=500000000,
-                timeout=2,
-            )
-            self.assertFalse(result.timed_out)
-            self.assertEqual(0, result.return_code)
+        result = self.sandbox.run_command(
+            ['python3', '-c', "import sys; sys.stdin.read(); print('done')"],
+            max_stack_size=10000000,
+            max_virtual_memory=500000000,
+            timeout=2,
+        )
+        self.assertFalse(result.timed_out)
+        self.assertEqual(0, result.return_code)
 
     def test_return_code_reported_and_stderr_recorded(self) -> None:
-        with AutograderSandbox() as sandbox:
-            result = sandbox.run_command(['ls', 'definitely not a file'])
-            self.assertNotEqual(0, result.return_code)
-            self.assertNotEqual('', result.stderr)
+        result = self.sandbox.run_command(['ls', 'definitely not a file'])
+        self.assertNotEqual(0, result.return_code)
+        self.assertNotEqual('', result.stderr)
 
     def test_context_manager(self) -> None:
-        with AutograderSandbox(name=self.name) as sandbox:
-            self.assertEqual(self.name, sandbox.name)
+        # Stale containers from an interrupted run may still exist, so
+        # the name needs to be unique across runs, not just within one.
+        name = 'awexome_container{}'.format(uuid.uuid4().hex)
+        with AutograderSandbox(name=name) as sandbox:
+            self.assertEqual(name, sandbox.name)
             # If the container was created successfully, we
             # should get an error if we try to create another
             # container with the same name.
             with self.assertRaises(subprocess.CalledProcessError):
-                with AutograderSandbox(name=self.name):
+                with AutograderSandbox(name=name):
                     pass
 
         # The container should have been deleted at this point,
         # so we should be able to create another with the same name.
-        with AutograderSandbox(name=self.name):
+        with AutograderSandbox(name=name):
             pass
 
     def test_sandbox_environment_variables_set(self) -> None:
@@ -204,102 +284,112 @@ class AutograderSandboxMiscTestCase(unittest.TestCase):
 
         sandbox = AutograderSandbox(
             environment_variables=self.environment_variables)
-        with sandbox, tempfile.NamedTemporaryFile('w+') as f:
-            f.write(print_env_var_script)
-            f.seek(0)
-            sandbox.add_files(f.name)
-            result = sandbox.run_command(['bash', os.path.basename(f.name)])
+        with sandbox:
+            result = sandbox.run_command(['bash', '-c', print_env_var_script])
             expected_output = ' '.join(
                 str(val) for val in self.environment_variables.values())
             expected_output += '\n'
             self.assertEqual(expected_output, result.stdout.read().decode())
 
     def test_home_env_var_set_in_preexec(self) -> None:
-        with AutograderSandbox() as sandbox:
-            result = sandbox.run_command(['bash', '-c', 'printf $HOME'])
-            self.assertEqual(SANDBOX_HOME_DIR_NAME, result.stdout.read().decode())
+        result = self.sandbox.run_command(['bash', '-c', 'printf "%s\\n%s" "$HOME" "$USER"'])
+        self.assertEqual(
+            SANDBOX_HOME_DIR_NAME + '\n' + SANDBOX_USERNAME, result.stdout.read().decode())
 
-            result = sandbox.run_command(['bash', '-c', 'printf $USER'])
-            self.assertEqual(SANDBOX_USERNAME, result.stdout.read().decode())
-
-            result = sandbox.run_command(['bash', '-c', 'printf $HOME'], as_root=True)
-            self.assertEqual('/root', result.stdout.read().decode())
+        result = self.sandbox.run_command(['bash', '-c', 'printf "%s" "$HOME"'], as_root=True)
+        self.assertEqual('/root', result.stdout.read().decode())
 
     def test_reset(self) -> None:
         with AutograderSandbox() as sandbox:
-            file_to_add = os.path.abspath(__file__)
-            sandbox.add_files(file_to_add)
+            sandbox.add_files(_THIS_FILE)
 
-            ls_result = sandbox.run_command(['ls']).stdout
-            self.assertEqual(os.path.basename(file_to_add) + '\n', ls_result.read().decode())
+            ls_result = sandbox.run_command(['ls']).stdout.read().decode()
+            self.assertEqual(_THIS_FILE_BASENAME + '\n', ls_result)
 
             sandbox.reset()
             self.assertEqual('', sandbox.run_command(['ls']).stdout.read().decode())
 
     def test_restart_added_files_preserved(self) -> None:
         with AutograderSandbox() as sandbox:
-            file_to_add = os.path.abspath(__file__)
-            sandbox.add_files(file_to_add)
+            sandbox.add_files(_THIS_FILE)
 
             ls_result = sandbox.run_command(['ls']).stdout.read().decode()
-            print(ls_result)
-            self.assertEqual(os.path.basename(file_to_add) + '\n', ls_result)
+            _debug_print(ls_result)
+            self.assertEqual(_THIS_FILE_BASENAME + '\n', ls_result)
 
             sandbox.restart()
 
             ls_result = sandbox.run_command(['ls']).stdout.read().decode()
-            self.assertEqual(os.path.basename(file_to_add) + '\n', ls_result)
+            self.assertEqual(_THIS_FILE_BASENAME + '\n', ls_result)
 
     def test_entire_process_tree_killed_on_timeout(self) -> None:
-        for program_str in _PROG_WITH_SUBPROCESS_STALL, _PROG_WITH_PARENT_PROC_STALL:
-            with AutograderSandbox() as sandbox:
-                ps_result = sandbox.run_command(['ps', '-aux']).stdout.read().decode()
-                print(ps_result)
-                num_ps_lines = len(ps_result.split('\n'))
-                print(num_ps_lines)
-
-                script_file = _add_string_to_sandbox_as_file(
-                    program_str, '.py', sandbox)
-
-                start_time = time.time()
-                result = sandbox.run_command(['python3', script_file], timeout=1)
+        with AutograderSandbox() as sandbox:
+            # Each command lists the running processes before it runs the
+            # program, so every listing after the first checks, from inside
+            # the sandbox, that the previous program's process tree was
+            # killed as soon as it timed out. (Host-side timing would also
+            # include docker exec overhead, which varies with load.)
+            # bash is running during every listing (it only execs the
+            # program once ps exits, and the trailing "true" keeps it
+            # around in the last one), so the listings should all be the
+            # same length.
+            ps_results = []
+            for program_str in _PROG_WITH_SUBPROCESS_STALL, _PROG_WITH_PARENT_PROC_STALL:
+                result = sandbox.run_command(
+                    ['bash', '-c', 'ps -eo user,pid,comm; echo ---; exec python3 -u -c "$0"',
+                     program_str],
+                    timeout=1)
                 self.assertTrue(result.timed_out)
 
-                time_elapsed = time.time() - start_time
-                self.assertLess(time_elapsed, _SLEEP_TIME // 2,
-                                msg='Killing processes took too long')
+                ps_result, prog_output = result.stdout.read().decode().split('---\n')
+                _debug_print(prog_output)
+                ps_results.append(ps_result)
 
-                ps_result_after_cmd = sandbox.run_command(
-                    ['ps', '-aux']).stdout.read().decode()
-                print(ps_result_after_cmd)
-                num_ps_lines_after_cmd = len(ps_result_after_cmd.split('\n'))
-                self.assertEqual(num_ps_lines, num_ps_lines_after_cmd)
+            ps_results.append(sandbox.run_command(
+                ['bash', '-c', 'ps -eo user,pid,comm; true']).stdout.read().decode())
+
+            for ps_result in ps_results:
+                _debug_print(ps_result)
+                commands = [line.split()[-1] for line in ps_result.splitlines()[1:]]
+                self.assertNotIn('sleep', commands)
+            num_ps_lines = [ps_result.count('\n') for ps_result in ps_results]
+            self.assertEqual([num_ps_lines[0]] * len(ps_results), num_ps_lines)
 
     def test_command_can_leave_child_process_running(self) -> None:
         with AutograderSandbox() as sandbox:
-            ps_result = sandbox.run_command(['ps', '-aux']).stdout.read().decode()
-            print(ps_result)
-            num_ps_lines = len(ps_result.split('\n'))
-            print(num_ps_lines)
-
-            script_file = _add_string_to_sandbox_as_file(_PROG_THAT_FORKS, '.py', sandbox)
-
-            result = sandbox.run_command(['python3', script_file], timeout=1)
+            # List the running processes before and after the program in
+            # the same command. We have ps print only executable names
+            # (not full command lines) so that the delimiter can't show up
+            # in its output. The trailing "true" keeps bash from exec-ing
+            # the last ps in place of itself, which would change the count.
+            result = sandbox.run_command(
+                ['bash', '-c',
+                 'ps -eo user,pid,comm; echo ---; python3 -u -c "$0"; echo ---; '
+                 'ps -eo user,pid,comm; true',
+                 _PROG_THAT_FORKS],
+                timeout=1)
             self.assertFalse(result.timed_out)
 
-            ps_result_after_cmd = sandbox.run_command(['ps', '-aux']).stdout.read().decode()
-            print(ps_result_after_cmd)
-            num_ps_lines_after_cmd = len(ps_result_after_cmd.split('\n'))
+            ps_result, prog_output, ps_result_after_cmd = (
+                result.stdout.read().decode().split('---\n'))
+            _debug_print(ps_result)
+            _debug_print(prog_output)
+            _debug_print(ps_result_after_cmd)
+            num_ps_lines = ps_result.count('\n')
+            num_ps_lines_after_cmd = ps_result_after_cmd.count('\n')
             self.assertEqual(num_ps_lines + 1, num_ps_lines_after_cmd)
 
     def test_try_to_change_cmd_runner(self) -> None:
         runner_path = '/usr/local/bin/cmd_runner.py'
-        with AutograderSandbox() as sandbox:
-            # Make sure the file path above is correct
-            sandbox.run_command(['cat', runner_path], check=True)
-            with self.assertRaises(SandboxCommandError):
-                sandbox.run_command(['touch', runner_path], check=True)
+        # Make sure the file path above is correct
+        self.sandbox.run_command(['cat', runner_path], check=True)
+        with self.assertRaises(SandboxCommandError):
+            self.sandbox.run_command(['touch', runner_path], check=True)
+
 
+# These tests mock out the docker commands, so they don't need a sandbox
+# (or Docker) to run.
+class AutograderSandboxMockedDockerTestCase(unittest.TestCase):
     @mock.patch('subprocess.run')
     @mock.patch('subprocess.check_call')
     def test_container_create_timeout(self, mock_check_call: mock.Mock, *args: object) -> None:
@@ -312,189 +402,211 @@ class AutograderSandboxMiscTestCase(unittest.TestCase):
             args, kwargs = mock_check_call.call_args
             self.assertEqual(timeout, kwargs['timeout'])
 
+    @mock.patch('subprocess.run')
+    @mock.patch('subprocess.check_call')
+    def test_exit_stops_then_removes_container(self, mock_check_call: mock.Mock,
+                                               *args: object) -> None:
+        with AutograderSandbox() as sandbox:
+            mock_check_call.reset_mock()
+
+        self.assertEqual(
+            [mock.call(['docker', 'stop', '--time', '1', sandbox.name]),
+             mock.call(['docker', 'rm', sandbox.name])],
+            mock_check_call.call_args_list)
+
+    @mock.patch('subprocess.run')
+    @mock.patch('subprocess.check_call')
+    def test_exit_fast_teardown_force_removes_container(self, mock_check_call: mock.Mock,
+                                                        *args: object) -> None:
+        with AutograderSandbox(fast_teardown=True) as sandbox:
+            mock_check_call.reset_mock()
+
+        self.assertEqual(
+            [mock.call(['docker', 'rm', '--force', sandbox.name])],
+            mock_check_call.call_args_list)
+
+
+class AutograderSandboxEncodeDecodeIOTestCase(_SharedSandboxTestCase):
+    non_utf = b'\x80 and some other stuff just because\n'
+    file_to_print = 'non-utf.txt'
+    temp_dir: 'tempfile.TemporaryDirectory[str]'
+    file_to_print_path: str
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        # Use a private directory so that tests running in parallel
+        # don't clobber each other's files.
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        cls.file_to_print_path = os.path.join(cls.temp_dir.name, cls.file_to_print)
+        with open(cls.file_to_print_path, 'wb') as f:
+            f.write(cls.non_utf)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.temp_dir.cleanup()
+        super().tearDownClass()
 
-class AutograderSandboxEncodeDecodeIOTestCase(unittest.TestCase):
     def setUp(self) -> None:
-        self.non_utf = b'\x80 and some other stuff just because\n'
+        super().setUp()
+        # The working directory is cleared after each test.
+        self.sandbox.add_files(self.file_to_print_path)
+
+    def test_non_utf_is_not_valid_utf8(self) -> None:
+        # Sanity check for the other tests in this class.
         with self.assertRaises(UnicodeDecodeError):
             self.non_utf.decode()
-        self.file_to_print = 'non-utf.txt'
-        with open(self.file_to_print, 'wb') as f:
-            f.write(self.non_utf)
-
-    def tearDown(self) -> None:
-        os.remove(self.file_to_print)
 
     def test_non_unicode_chars_in_normal_output(self) -> None:
-        with AutograderSandbox() as sandbox:
-            sandbox.add_files(self.file_to_print)
-
-            result = sandbox.run_command(['cat', self.file_to_print])
-            stdout = result.stdout.read()
-            print(stdout)
-            self.assertEqual(self.non_utf, stdout)
+        result = self.sandbox.run_command(['cat', self.file_to_print])
+        stdout = result.stdout.read()
+        _debug_print(stdout)
+        self.assertEqual(self.non_utf, stdout)
 
-            result = sandbox.run_command(['bash', '-c', '>&2 cat ' + self.file_to_print])
-            stderr = result.stderr.read()
-            print(stderr)
-            self.assertEqual(self.non_utf, stderr)
+        result = self.sandbox.run_command(['bash', '-c', '>&2 cat ' + self.file_to_print])
+        stderr = result.stderr.read()
+        _debug_print(stderr)
+        self.assertEqual(self.non_utf, stderr)
 
     def test_non_unicode_chars_in_output_command_timed_out(self) -> None:
-        with AutograderSandbox() as sandbox:
-            sandbox.add_files(self.file_to_print)
-
-            result = sandbox.run_command(
-                ['bash', '-c', 'cat {}; sleep 5'.format(self.file_to_print)],
-                timeout=1)
-            self.assertTrue(result.timed_out)
-            self.assertEqual(self.non_utf, result.stdout.read())
-
-        with AutograderSandbox() as sandbox:
-            sandbox.add_files(self.file_to_print)
-
-            result = sandbox.run_command(
-                ['bash', '-c', '>&2 cat {}; sleep 5'.format(self.file_to_print)],
-                timeout=1)
-            self.assertTrue(result.timed_out)
-            self.assertEqual(self.non_utf, result.stderr.read())
+        result = self.sandbox.run_command(
+            ['bash', '-c', 'cat {}; sleep 5'.format(self.file_to_print)],
+            timeout=1)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(self.non_utf, result.stdout.read())
+
+        result = self.sandbox.run_command(
+            ['bash', '-c', '>&2 cat {}; sleep 5'.format(self.file_to_print)],
+            timeout=1)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(self.non_utf, result.stderr.read())
 
     def test_non_unicode_chars_in_output_on_process_error(self) -> None:
-        with AutograderSandbox() as sandbox:
-            sandbox.add_files(self.file_to_print)
+        with self.assertRaises(SandboxCommandError) as cm:
+            self.sandbox.run_command(
+                ['bash', '-c', 'cat {}; exit 1'.format(self.file_to_print)],
+                check=True)
+        self.assertIn(self.non_utf.decode('utf-8', 'surrogateescape'), str(cm.exception))
 
-            with self.assertRaises(SandboxCommandError) as cm:
-                sandbox.run_command(
-                    ['bash', '-c', 'cat {}; exit 1'.format(self.file_to_print)],
-                    check=True)
-            self.assertIn(self.non_utf.decode('utf-8', 'surrogateescape'), str(cm.exception))
+        with self.assertRaises(SandboxCommandError) as cm:
+            self.sandbox.run_command(
+                ['bash', '-c', '>&2 cat {}; exit 1'.format(self.file_to_print)],
+                check=True)
+        self.assertIn(self.non_utf.decode('utf-8', 'surrogateescape'), str(cm.exception))
 
-        with AutograderSandbox() as sandbox:
-            sandbox.add_files(self.file_to_print)
 
-            with self.assertRaises(SandboxCommandError) as cm:
-                sandbox.run_command(
-                    ['bash', '-c', '>&2 cat {}; exit 1'.format(self.file_to_print)],
-                    check=True)
-            self.assertIn(self.non_utf.decode('utf-8', 'surrogateescape'), str(cm.exception))
+# Long enough that a process tree that wasn't killed at its 1 second
+# timeout would still be running when the process tree tests list the
+# running processes afterwards, even on a heavily loaded host. The
+# programs are killed at the timeout, so this doesn't add to test time.
+_SLEEP_TIME = 10
 
-
-_SLEEP_TIME = 6
+# These programs should be run with "python3 -u" so that their output
+# isn't lost in a buffer when they are killed.
 
 _PROG_THAT_FORKS = """
 import subprocess
 
-print('hello', flush=True)
+print('hello')
 subprocess.Popen(['sleep', '{}'])
-print('goodbye', flush=True)
+print('goodbye')
 """.format(_SLEEP_TIME)
 
 _PROG_WITH_SUBPROCESS_STALL = """
 import subprocess
 
-print('hello', flush=True)
+print('hello')
 subprocess.call(['sleep', '{}'])
-print('goodbye', flush=True)
+print('goodbye')
 """.format(_SLEEP_TIME)
 
 _PROG_WITH_PARENT_PROC_STALL = """
 import subprocess
 import time
 
-print('hello', flush=True)
+print('hello')
 subprocess.Popen(['sleep', '{}'])
 time.sleep({})
-print('goodbye', flush=True)
+print('goodbye')
 """.format(_SLEEP_TIME * 2, _SLEEP_TIME)
 
 
-class AutograderSandboxResourceLimitTestCase(unittest.TestCase):
+class AutograderSandboxResourceLimitTestCase(_SharedSandboxTestCase):
 
     def setUp(self) -> None:
-        self.sandbox = AutograderSandbox()
-
         self.small_virtual_mem_limit = mb_to_bytes(100)
         self.large_virtual_mem_limit = gb_to_bytes(1)
 
     def test_run_command_timeout_exceeded(self) -> None:
-        with self.sandbox:
-            result = self.sandbox.run_command(["sleep", "10"], timeout=1)
-            self.assertTrue(result.timed_out)
+        result = self.sandbox.run_command(["sleep", "10"], timeout=1)
+        self.assertTrue(result.timed_out)
 
     def test_block_process_spawn(self) -> None:
         cmd = ['bash', '-c', 'echo spam | cat > egg.txt']
-        with self.sandbox:
-            # Spawning processes is allowed by default
-            filename = _add_string_to_sandbox_as_file(
-                _PROCESS_SPAWN_PROG_TMPL.format(num_processes=12, sleep_time=3), '.py',
-                self.sandbox
-            )
-            result = self.sandbox.run_command(['python3', filename])
-            self.assertEqual(0, result.return_code)
-
-            result = self.sandbox.run_command(['python3', filename], block_process_spawn=True)
-            stdout = result.stdout.read().decode()
-            print(stdout)
-            stderr = result.stderr.read().decode()
-            print(stderr)
-            self.assertNotEqual(0, result.return_code)
-            self.assertIn('BlockingIOError', stderr)
-            self.assertIn('Resource temporarily unavailable', stderr)
+        # Spawning processes is allowed by default
+        prog = _PROCESS_SPAWN_PROG_TMPL.format(num_processes=12, sleep_time=3)
+        result = self.sandbox.run_command(['python3', '-c', prog])
+        self.assertEqual(0, result.return_code)
+
+        result = self.sandbox.run_command(['python3', '-c', prog], block_process_spawn=True)
+        stdout = result.stdout.read().decode()
+        _debug_print(stdout)
+        stderr = result.stderr.read().decode()
+        _debug_print(stderr)
+        self.assertNotEqual(0, result.return_code)
+        self.assertIn('BlockingIOError', stderr)
+        self.assertIn('Resource temporarily unavailable', stderr)
 
     def test_command_exceeds_stack_size_limit(self) -> None:
         stack_size_limit = mb_to_bytes(5)
         mem_to_use = stack_size_limit * 2
-        with self.sandbox:
-            self._do_stack_resource_limit_test(
-                mem_to_use, stack_size_limit, self.sandbox)
+        self._do_stack_resource_limit_test(
+            mem_to_use, stack_size_limit, self.sandbox)
 
     def test_command_doesnt_exceed_stack_size_limit(self) -> None:
         stack_size_limit = mb_to_bytes(30)
         mem_to_use = stack_size_limit // 2
-        with self.sandbox:
-            self._do_stack_resource_limit_test(
-                mem_to_use, stack_size_limit, self.sandbox)
+        self._do_stack_resource_limit_test(
+            mem_to_use, stack_size_limit, self.sandbox)
 
     def test_command_exceeds_virtual_mem_limit(self) -> None:
         virtual_mem_limit = mb_to_bytes(100)
         mem_to_use = virtual_mem_limit * 2
-        with self.sandbox:
-            self._do_heap_resource_limit_test(
-                mem_to_use, virtual_mem_limit, self.sandbox)
+        self._do_heap_resource_limit_test(
+            mem_to_use, virtual_mem_limit, self.sandbox)
 
     def test_command_doesnt_exceed_virtual_mem_limit(self) -> None:
         virtual_mem_limit = mb_to_bytes(100)
         mem_to_use = virtual_mem_limit // 2
-        with self.sandbox:
-            self._do_heap_resource_limit_test(
-                mem_to_use, virtual_mem_limit, self.sandbox)
+        self._do_heap_resource_limit_test(
+            mem_to_use, virtual_mem_limit, self.sandbox)
 
     def test_run_subsequent_commands_with_different_resource_limits(self) -> None:
-        with self.sandbox:
-            # Under limit
-            self._do_stack_resource_limit_test(
-                mb_to_bytes(1), mb_to_bytes(10), self.sandbox)
-            # Over previous limit
-            self._do_stack_resource_limit_test(
-                mb_to_bytes(20), mb_to_bytes(10), self.sandbox)
-            # Limit raised
-            self._do_stack_resource_limit_test(
-                mb_to_bytes(20), mb_to_bytes(50), self.sandbox)
-            # Over new limit
-            self._do_stack_resource_limit_test(
-                mb_to_bytes(40), mb_to_bytes(30), self.sandbox)
-
-            # Under limit
-            self._do_heap_resource_limit_test(
-                mb_to_bytes(10), mb_to_bytes(100), self.sandbox)
-            # Over previous limit
-            self._do_heap_resource_limit_test(
-                mb_to_bytes(200), mb_to_bytes(100), self.sandbox)
-            # Limit raised
-            self._do_heap_resource_limit_test(
-                mb_to_bytes(200), mb_to_bytes(300), self.sandbox)
-            # Over new limit
-            self._do_heap_resource_limit_test(
-                mb_to_bytes(250), mb_to_bytes(200), self.sandbox)
+        # Under limit
+        self._do_stack_resource_limit_test(
+            mb_to_bytes(1), mb_to_bytes(10), self.sandbox)
+        # Over previous limit
+        self._do_stack_resource_limit_test(
+            mb_to_bytes(20), mb_to_bytes(10), self.sandbox)
+        # Limit raised
+        self._do_stack_resource_limit_test(
+            mb_to_bytes(20), mb_to_bytes(50), self.sandbox)
+        # Over new limit
+        self._do_stack_resource_limit_test(
+            mb_to_bytes(40), mb_to_bytes(30), self.sandbox)
+
+        # Under limit
+        self._do_heap_resource_limit_test(
+            mb_to_bytes(10), mb_to_bytes(100), self.sandbox)
+        # Over previous limit
+        self._do_heap_resource_limit_test(
+            mb_to_bytes(200), mb_to_bytes(100), self.sandbox)
+        # Limit raised
+        self._do_heap_resource_limit_test(
+            mb_to_bytes(200), mb_to_bytes(300), self.sandbox)
+        # Over new limit
+        self._do_heap_resource_limit_test(
+            mb_to_bytes(250), mb_to_bytes(200), self.sandbox)
 
     def _do_stack_resource_limit_test(
         self, mem_to_use: int, mem_limit: int, sandbox: AutograderSandbox
@@ -526,67 +638,64 @@ class AutograderSandboxResourceLimitTestCase(unittest.TestCase):
         ulimits except for nproc are supposed to be process-linked
         rather than UID-linked.
         """
-        self._do_parallel_container_stack_limit_test(
-            16, mb_to_bytes(20), mb_to_bytes(30))
-
-        self._do_parallel_container_heap_limit_test(
-            16, mb_to_bytes(300), mb_to_bytes(500))
-
-    def _do_parallel_container_stack_limit_test(
-        self, num_containers: int, mem_to_use: int, mem_limit: int
-    ) -> None:
-        self._do_parallel_container_resource_limit_test(
-            _run_stack_usage_prog, num_containers, mem_to_use, mem_limit)
-
-    def _do_parallel_container_heap_limit_test(
-        self, num_containers: int, mem_to_use: int, mem_limit: int
-    ) -> None:
-        self._do_parallel_container_resource_limit_test(
-            _run_heap_usage_prog, num_containers, mem_to_use, mem_limit)
-
-    def _do_parallel_container_resource_limit_test(
-        self, func_to_run: Callable[[int, int, AutograderSandbox], Optional[int]],
-        num_containers: int,
-        amount_to_use: int,
-        resource_limit: int
-    ) -> None:
-        with multiprocessing.Pool(processes=num_containers) as p:
-            return_codes = p.starmap(
-                func_to_run,
-                itertools.repeat((amount_to_use, resource_limit, None),
-                                 num_containers))
-
-        print(return_codes)
-        for ret_code in return_codes:
-            self.assertEqual(0, ret_code)
+        num_containers = 16
+
+        # Each worker runs both checks in the same sandbox, so that we
+        # only have to start num_containers containers.
+        def run_checks(_: int) -> List[Optional[int]]:
+            sandbox = AutograderSandbox()
+            with _SANDBOX_START_SEMAPHORE:
+                sandbox.__enter__()
+            try:
+                return [
+                    _run_stack_usage_prog(mb_to_bytes(20), mb_to_bytes(30), sandbox),
+                    _run_heap_usage_prog(mb_to_bytes(300), mb_to_bytes(500), sandbox),
+                ]
+            finally:
+                sandbox.__exit__()
+
+        # Each worker spends its time waiting on docker subprocesses, so
+        # threads give us the same parallelism as worker processes.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_containers) as executor:
+            return_codes = list(executor.map(run_checks, range(num_containers)))
+
+        _debug_print(return_codes)
+        for ret_codes in return_codes:
+            self.assertEqual([0, 0], ret_codes)
+
+
+# Limits how many sandboxes the parallel container tests start at the
+# same time. Starting many containers at once on a small host makes the
+# Docker daemon slower rather than faster.
+_SANDBOX_START_SEMAPHORE = threading.BoundedSemaphore(min(16, os.cpu_count() or 1))
 
 
 def _run_stack_usage_prog(
     mem_to_use: int, mem_limit: int, sandbox: AutograderSandbox
 ) -> Optional[int]:
-    def _run_prog(sandbox: AutograderSandbox) -> Optional[int]:
-        prog = _STACK_USAGE_PROG_TMPL.format(num_bytes_on_stack=mem_to_use)
-        filename = _add_string_to_sandbox_as_file(prog, '.cpp', sandbox)
-        exe_name = _compile_in_sandbox(sandbox, filename)
-        result = sandbox.run_command(
-            ['./' + exe_name], max_stack_size=mem_limit)
-        return result.return_code
-
-    return _call_function_and_allocate_sandbox_if_needed(_run_prog, sandbox)
+    exe_name = _add_prog_to_sandbox(sandbox, _STACK_USAGE_PROG)
+    result = sandbox.run_command(
+        ['./' + exe_name, str(mem_to_use)], max_stack_size=mem_limit)
+    return result.return_code
 
 
-_STACK_USAGE_PROG_TMPL = """#include <iostream>
+# Takes the number of bytes to allocate on the stack as its only
+# command-line argument, so that it only needs to be compiled once.
+_STACK_USAGE_PROG = """#include <alloca.h>
+#include <iostream>
 #include <thread>
 #include <cstring>
+#include <string>
 
 using namespace std;
 
-int main() {{
-    char stacky[{num_bytes_on_stack}];
-    for (int i = 0; i < {num_bytes_on_stack} - 1; ++i) {{
+int main(int argc, char** argv) {
+    const size_t num_bytes_on_stack = stoull(argv[1]);
+    char* stacky = static_cast<char*>(alloca(num_bytes_on_stack));
+    for (size_t i = 0; i < num_bytes_on_stack - 1; ++i) {
         stacky[i] = 'a';
-    }}
-    stacky[{num_bytes_on_stack} - 1] = '\\0';
+    }
+    stacky[num_bytes_on_stack - 1] = '\\0';
 
     cout << "Sleeping" << endl;
     this_thread::sleep_for(chrono::seconds(2));
@@ -594,58 +703,112 @@ int main() {{
     cout << "Allocated " << strlen(stacky) + 1 << " bytes" << endl;
 
     return 0;
-}}
+}
 """
 
 
 def _run_heap_usage_prog(
     mem_to_use: int, mem_limit: int, sandbox: AutograderSandbox
 ) -> Optional[int]:
-    def _run_prog(sandbox: AutograderSandbox) -> Optional[int]:
-        prog = _HEAP_USAGE_PROG_TMPL.format(num_bytes_on_heap=mem_to_use, sleep_time=2)
-        filename = _add_string_to_sandbox_as_file(prog, '.cpp', sandbox)
-        exe_name = _compile_in_sandbox(sandbox, filename)
-        result = result = sandbox.run_command(
-            ['./' + exe_name], max_virtual_memory=mem_limit)
-
-        return result.return_code
+    exe_name = _add_prog_to_sandbox(sandbox, _HEAP_USAGE_PROG)
+    result = sandbox.run_command(
+        ['./' + exe_name, str(mem_to_use), '2'], max_virtual_memory=mem_limit)
 
-    return _call_function_and_allocate_sandbox_if_needed(_run_prog, sandbox)
+    return result.return_code
 
 
-_HEAP_USAGE_PROG_TMPL = """#include <iostream>
+# Takes the number of bytes to allocate and the number of seconds to
+# sleep for after filling them as its command-line arguments.
+_HEAP_USAGE_PROG = """#include <iostream>
 #include <thread>
 #include <cstring>
+#include <string>
 
 using namespace std;
 
-const size_t num_bytes_on_heap = {num_bytes_on_heap};
-
-int main() {{
+int main(int argc, char** argv) {
+    const size_t num_bytes_on_heap = stoull(argv[1]);
     cout << "Allocating an array of " << num_bytes_on_heap << " bytes" << endl;
     char* heapy = new char[num_bytes_on_heap];
-    for (size_t i = 0; i < num_bytes_on_heap - 1; ++i) {{
+    for (size_t i = 0; i < num_bytes_on_heap - 1; ++i) {
         heapy[i] = 'a';
-    }}
+    }
     heapy[num_bytes_on_heap - 1] = '\\0';
 
     cout << "Sleeping" << endl;
-    this_thread::sleep_for(chrono::seconds({sleep_time}));
+    this_thread::sleep_for(chrono::seconds(stoi(argv[2])));
 
     cout << "Allocated and filled " << strlen(heapy) + 1 << " bytes" << endl;
     return 0;
-}}
+}
 """
 
 
-def _compile_in_sandbox(sandbox: AutograderSandbox, *files_to_compile: str) -> str:
-    exe_name = 'prog'
+def _compile_in_sandbox(
+    sandbox: AutograderSandbox, *files_to_compile: str, exe_name: str = 'prog'
+) -> str:
     sandbox.run_command(
-        ['g++', '--std=c++11', '-Wall', '-Werror'] + list(files_to_compile)
+        ['g++', '-pipe', '--std=c++11', '-Wall', '-Werror'] + list(files_to_compile)
         + ['-o', exe_name], check=True)
     return exe_name
 
 
+# Executables for the C++ programs used by the resource limit tests
+# (C++ source code -> path to the executable on the host). Each program
+# is compiled in the first sandbox that needs it and then copied out, so
+# that other sandboxes (e.g. the ones started by the parallel container
+# tests) only have to copy the executable in.
+_PROG_EXECUTABLES: Dict[str, str] = {}
+_PROG_EXECUTABLES_DIR = tempfile.TemporaryDirectory()
+
+# Keeps track of which programs have already been added to a given
+# sandbox (C++ source code -> executable name), so that tests that run
+# the same program several times only have to add it once.
+# Entries must be removed when a sandbox's working directory is cleared.
+_PROGS_IN_SANDBOX: 'weakref.WeakKeyDictionary[AutograderSandbox, Dict[str, str]]' = (
+    weakref.WeakKeyDictionary())
+
+# Guards _PROG_EXECUTABLES and _PROGS_IN_SANDBOX, which are accessed from
+# several threads by the parallel container tests.
+_PROGS_LOCK = threading.Lock()
+
+
+def _add_prog_to_sandbox(sandbox: AutograderSandbox, prog: str) -> str:
+    with _PROGS_LOCK:
+        progs_in_sandbox = _PROGS_IN_SANDBOX.setdefault(sandbox, {})
+        if prog in progs_in_sandbox:
+            return progs_in_sandbox[prog]
+
+        exe_path = _PROG_EXECUTABLES.get(prog)
+        if exe_path is None:
+            exe_name = _compile_prog_and_copy_out(sandbox, prog)
+            progs_in_sandbox[prog] = exe_name
+            return exe_name
+
+    sandbox.add_files(exe_path)
+    exe_name = os.path.basename(exe_path)
+    with _PROGS_LOCK:
+        progs_in_sandbox[prog] = exe_name
+    return exe_name
+
+
+# Compiles prog in the given sandbox and saves a copy of the executable
+# in _PROG_EXECUTABLES. Returns the executable's name in the sandbox.
+# The caller must hold _PROGS_LOCK.
+def _compile_prog_and_copy_out(sandbox: AutograderSandbox, prog: str) -> str:
+    filename = _add_string_to_sandbox_as_file(prog, '.cpp', sandbox)
+    exe_name = _compile_in_sandbox(sandbox, filename, exe_name=os.path.splitext(filename)[0])
+
+    exe_path = os.path.join(_PROG_EXECUTABLES_DIR.name, exe_name)
+    with open(exe_path, 'wb') as f:
+        f.write(sandbox.run_command(['cat', exe_name], check=True).stdout.read())
+    # add_files() preserves the file's permissions.
+    os.chmod(exe_path, 0o755)
+
+    _PROG_EXECUTABLES[prog] = exe_path
+    return exe_name
+
+
 _PROCESS_SPAWN_PROG_TMPL = """
 import time
 import subprocess
@@ -666,43 +829,27 @@ for proc in processes:
 def _add_string_to_sandbox_as_file(
     string: str, file_extension: str, sandbox: AutograderSandbox
 ) -> str:
-    with tempfile.NamedTemporaryFile('w+', suffix=file_extension) as f:
-        f.write(string)
-        f.seek(0)
-        sandbox.add_files(f.name)
-
-        return os.path.basename(f.name)
-
-
-ReturnType = TypeVar('ReturnType')
+    # Writing the file from inside the sandbox saves us a host temporary
+    # file and the "docker cp" and chown that add_files() does.
+    filename = uuid.uuid4().hex + file_extension
+    sandbox.run_command(
+        ['bash', '-c', 'printf "%s" "$1" > "$0"', filename, string], check=True)
+    return filename
 
 
-def _call_function_and_allocate_sandbox_if_needed(
-    func: Callable[[AutograderSandbox], ReturnType], sandbox: Optional[AutograderSandbox]
-) -> ReturnType:
-    if sandbox is None:
-        sandbox = AutograderSandbox()
-        with sandbox:
-            return func(sandbox)
-    else:
-        return func(sandbox)
-
 # -----------------------------------------------------------------------------
 
 
 class ContainerLevelResourceLimitTestCase(unittest.TestCase):
     def test_pid_limit(self) -> None:
         with AutograderSandbox() as sandbox:
-            filename = _add_string_to_sandbox_as_file(
-                _PROCESS_SPAWN_PROG_TMPL.format(num_processes=1000, sleep_time=5), '.py', sandbox
-            )
-
+            prog = _PROCESS_SPAWN_PROG_TMPL.format(num_processes=1000, sleep_time=5)
             # The limit should apply to all users, root or otherwise
-            result = sandbox.run_command(['python3', filename], as_root=True)
+            result = sandbox.run_command(['python3', '-c', prog], as_root=True)
             stdout = result.stdout.read().decode()
-            print(stdout)
+            _debug_print(stdout)
             stderr = result.stderr.read().decode()
-            print(stderr)
+            _debug_print(stderr)
             self.assertNotEqual(0, result.return_code)
             self.assertIn('BlockingIOError', stderr)
             self.assertIn('Resource temporarily unavailable', stderr)
@@ -727,150 +874,148 @@ for i in range(2):
         proc.communicate()
 """
         with AutograderSandbox() as sandbox:
-            filename = _add_string_to_sandbox_as_file(
-                spawn_twice_prog.format(num_processes=350, sleep_time=5), '.py', sandbox
-            )
-
-            result = sandbox.run_command(['python3', filename])
-            print(result.stdout.read().decode())
-            print(result.stderr.read().decode())
+            # The sleep only needs to outlast spawning the rest of the
+            # processes, so that all 350 of them are running at once.
+            result = sandbox.run_command(
+                ['python3', '-c', spawn_twice_prog.format(num_processes=350, sleep_time=3)])
+            _debug_print(result.text_stdout)
+            _debug_print(result.text_stderr)
             self.assertEqual(0, result.return_code)
 
     def test_fallback_time_limit_is_twice_timeout(self) -> None:
-        with AutograderSandbox(min_fallback_timeout=4) as sandbox:
-            to_throw = subprocess.TimeoutExpired([], 10)
-            subprocess_run_mock = mock.Mock(side_effect=to_throw)
-            with mock.patch('subprocess.run', new=subprocess_run_mock):
-                result = sandbox.run_command(['sleep', '20'], timeout=5)
-                stdout = result.stdout.read().decode()
-                stderr = result.stderr.read().decode()
-                print(stdout)
-                print(stderr)
-
-                args, kwargs = subprocess_run_mock.call_args
-                self.assertEqual(10, kwargs['timeout'])
+        # subprocess.run is mocked out, so the sandbox never needs to be started.
+        sandbox = AutograderSandbox(min_fallback_timeout=4)
+        to_throw = subprocess.TimeoutExpired([], 10)
+        subprocess_run_mock = mock.Mock(side_effect=to_throw)
+        with mock.patch('subprocess.run', new=subprocess_run_mock):
+            result = sandbox.run_command(['sleep', '20'], timeout=5)
+            stdout = result.stdout.read().decode()
+            stderr = result.stderr.read().decode()
+            _debug_print(stdout)
+            _debug_print(stderr)
 
-                self.assertTrue(result.timed_out)
-                self.assertIsNone(result.return_code)
-                self.assertIn('fallback timeout', stderr)
+            args, kwargs = subprocess_run_mock.call_args
+            self.assertEqual(10, kwargs['timeout'])
+
+            self.assertTrue(result.timed_out)
+            self.assertIsNone(result.return_code)
+            self.assertIn('fallback timeout', stderr)
 
     def test_fallback_time_limit_is_min_fallback_timeout(self) -> None:
-        with AutograderSandbox(min_fallback_timeout=60) as sandbox:
-            to_throw = subprocess.TimeoutExpired([], 60)
-            subprocess_run_mock = mock.Mock(side_effect=to_throw)
-            with mock.patch('subprocess.run', new=subprocess_run_mock):
-                result = sandbox.run_command(['sleep', '20'], timeout=10)
-                stdout = result.stdout.read().decode()
-                stderr = result.stderr.read().decode()
+        sandbox = AutograderSandbox(min_fallback_timeout=60)
+        to_throw = subprocess.TimeoutExpired([], 60)
+        subprocess_run_mock = mock.Mock(side_effect=to_throw)
+        with mock.patch('subprocess.run', new=subprocess_run_mock):
+            result = sandbox.run_command(['sleep', '20'], timeout=10)
+            stdout = result.stdout.read().decode()
+            stderr = result.stderr.read().decode()
 
-                args, kwargs = subprocess_run_mock.call_args
-                self.assertEqual(60, kwargs['timeout'])
+            args, kwargs = subprocess_run_mock.call_args
+            self.assertEqual(60, kwargs['timeout'])
 
-                self.assertTrue(result.timed_out)
-                self.assertIsNone(result.return_code)
-                self.assertIn('fallback timeout', stderr)
+            self.assertTrue(result.timed_out)
+            self.assertIsNone(result.return_code)
+            self.assertIn('fallback timeout', stderr)
 
     # Since we disable the OOM killer for the container, we expect
     # commands to time out while waiting for memory to be paged
     # in and out.
     def test_memory_limit_no_oom_kill(self) -> None:
-        program_str = _HEAP_USAGE_PROG_TMPL.format(num_bytes_on_heap=4 * 10 ** 9, sleep_time=0)
         with AutograderSandbox(memory_limit='2g') as sandbox:
-            filename = _add_string_to_sandbox_as_file(program_str, '.cpp', sandbox)
-            exe_name = _compile_in_sandbox(sandbox, filename)
+            exe_name = _add_prog_to_sandbox(sandbox, _HEAP_USAGE_PROG)
             # The limit should apply to all users, root or otherwise
-            result = sandbox.run_command(['./' + exe_name], timeout=20, as_root=True)
+            result = sandbox.run_command(
+                ['./' + exe_name, str(4 * 10 ** 9), '0'], timeout=20, as_root=True)
 
-            print(result.return_code)
-            print(result.stdout.read().decode())
-            print(result.stderr.read().decode())
+            _debug_print(result.return_code)
+            _debug_print(result.text_stdout)
+            _debug_print(result.text_stderr)
             self.assertTrue(result.timed_out)
 
 # -----------------------------------------------------------------------------
 
 
 _GOOGLE_IP_ADDR = "216.58.214.196"
+# Send the pings 0.2 seconds apart (the shortest interval allowed for
+# non-root users) rather than the default of 1 second. ping succeeds if
+# any of them gets a reply.
+_GOOGLE_PING_CMD = ['ping', '-c', '5', '-i', '0.2', _GOOGLE_IP_ADDR]
 
 
-class AutograderSandboxNetworkAccessTestCase(unittest.TestCase):
-
-    def setUp(self) -> None:
-        super().setUp()
-
-        self.google_ping_cmd = ['ping', '-c', '5', _GOOGLE_IP_ADDR]
+class AutograderSandboxNetworkAccessTestCase(_SharedSandboxTestCase):
 
     def test_networking_disabled(self) -> None:
-        with AutograderSandbox() as sandbox:
-            result = sandbox.run_command(self.google_ping_cmd)
-            self.assertNotEqual(0, result.return_code)
-
-    def test_networking_enabled(self) -> None:
-        with AutograderSandbox(allow_network_access=True) as sandbox:
-            result = sandbox.run_command(self.google_ping_cmd)
-            self.assertEqual(0, result.return_code)
+        result = self.sandbox.run_command(_GOOGLE_PING_CMD)
+        self.assertNotEqual(0, result.return_code)
 
     def test_set_allow_network_access(self) -> None:
+        # Network access can only be changed while the sandbox is
+        # stopped, so this test needs its own sandbox.
         sandbox = AutograderSandbox()
         self.assertFalse(sandbox.allow_network_access)
         with sandbox:
-            result = sandbox.run_command(self.google_ping_cmd)
+            result = sandbox.run_command(_GOOGLE_PING_CMD)
             self.assertNotEqual(0, result.return_code)
 
         sandbox.allow_network_access = True
         self.assertTrue(sandbox.allow_network_access)
         with sandbox:
-            result = sandbox.run_command(self.google_ping_cmd)
+            result = sandbox.run_command(_GOOGLE_PING_CMD)
             self.assertEqual(0, result.return_code)
 
         sandbox.allow_network_access = False
         self.assertFalse(sandbox.allow_network_access)
         with sandbox:
-            result = sandbox.run_command(self.google_ping_cmd)
+            result = sandbox.run_command(_GOOGLE_PING_CMD)
             self.assertNotEqual(0, result.return_code)
 
     def test_error_set_allow_network_access_while_running(self) -> None:
-        with AutograderSandbox() as sandbox:
-            with self.assertRaises(ValueError):
-                sandbox.allow_network_access = True
+        with self.assertRaises(ValueError):
+            self.sandbox.allow_network_access = True
+
+        self.assertFalse(self.sandbox.allow_network_access)
+        result = self.sandbox.run_command(_GOOGLE_PING_CMD)
+        self.assertNotEqual(0, result.return_code)
 
-            self.assertFalse(sandbox.allow_network_access)
-            result = sandbox.run_command(self.google_ping_cmd)
-            self.assertNotEqual(0, result.return_code)
 
+class AutograderSandboxNetworkAccessEnabledTestCase(_SharedSandboxTestCase):
+    sandbox_kwargs = {'allow_network_access': True}
+
+    def test_networking_enabled(self) -> None:
+        result = self.sandbox.run_command(_GOOGLE_PING_CMD)
+        self.assertEqual(0, result.return_code)
 
-class AutograderSandboxCopyFilesTestCase(unittest.TestCase):
+
+class AutograderSandboxCopyFilesTestCase(_SharedSandboxTestCase):
 
     def test_copy_files_into_sandbox(self) -> None:
-        files = []
-        try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            expected_contents = []
+            filenames = []
             for i in range(10):
-                f = tempfile.NamedTemporaryFile(mode='w+')
-                f.write('this is file {}'.format(i))
-                f.seek(0)
-                files.append(f)
-
-            filenames = [file_.name for file_ in files]
-
-            with AutograderSandbox() as sandbox:
-                sandbox.add_files(*filenames)
-
-                ls_result = sandbox.run_command(['ls']).stdout.read().decode()
-                actual_filenames = [
-                    filename.strip() for filename in ls_result.split()]
-                expected_filenames = [
-                    os.path.basename(filename) for filename in filenames]
-                self.assertCountEqual(expected_filenames, actual_filenames)
-
-                for file_ in files:
-                    file_.seek(0)
-                    expected_content = file_.read()
-                    actual_content = sandbox.run_command(
-                        ['cat', os.path.basename(file_.name)]
-                    ).stdout.read().decode()
-                    self.assertEqual(expected_content, actual_content)
-        finally:
-            for file_ in files:
-                file_.close()
+                content = 'this is file {}'.format(i)
+                filename = os.path.join(temp_dir, 'file_{}.txt'.format(i))
+                with open(filename, 'w') as f:
+                    f.write(content)
+                expected_contents.append(content)
+                filenames.append(filename)
+
+            self.sandbox.add_files(*filenames)
+
+            ls_result = self.sandbox.run_command(['ls']).stdout.read().decode()
+            expected_filenames = [
+                os.path.basename(filename) for filename in filenames]
+            self.assertEqual(set(expected_filenames), set(ls_result.split()))
+
+            # Print every file's contents with a single command,
+            # following each one with a null byte.
+            cat_result = self.sandbox.run_command(
+                ['bash', '-c', 'for f; do cat "$f"; printf "\\0"; done', 'cat_files']
+                + expected_filenames,
+                check=True
+            ).stdout.read().decode()
+            actual_contents = cat_result.split('\0')[:-1]
+            self.assertEqual(expected_contents, actual_contents)
 
     def test_copy_and_rename_file_into_sandbox(self) -> None:
         expected_content = 'this is a file'
@@ -878,17 +1023,16 @@ class AutograderSandboxCopyFilesTestCase(unittest.TestCase):
             f.write(expected_content)
             f.seek(0)
 
-            with AutograderSandbox() as sandbox:
-                new_name = 'new_filename.txt'
-                sandbox.add_and_rename_file(f.name, new_name)
+            new_name = 'new_filename.txt'
+            self.sandbox.add_and_rename_file(f.name, new_name)
 
-                ls_result = sandbox.run_command(['ls']).stdout.read().decode()
-                actual_filenames = [filename.strip() for filename in ls_result.split()]
-                expected_filenames = [new_name]
-                self.assertCountEqual(expected_filenames, actual_filenames)
+            # List the directory and print the file in one command.
+            result = self.sandbox.run_command(
+                ['bash', '-c', 'ls; echo ---; cat "$0"', new_name], check=True)
+            ls_result, actual_content = result.stdout.read().decode().split('---\n')
 
-                actual_content = sandbox.run_command(['cat', new_name]).stdout.read().decode()
-                self.assertEqual(expected_content, actual_content)
+            self.assertEqual([new_name], ls_result.split())
+            self.assertEqual(expected_content, actual_content)
 
     def test_add_files_root_owner_and_read_only(self) -> None:
         original_content = "some stuff you shouldn't change"
@@ -899,39 +1043,26 @@ class AutograderSandboxCopyFilesTestCase(unittest.TestCase):
 
             added_filename = os.path.basename(f.name)
 
-            with AutograderSandbox() as sandbox:
-                sandbox.add_files(f.name, owner='root', read_only=True)
-
-                actual_content = sandbox.run_command(
-                    ['cat', added_filename], check=True
-                ).stdout.read().decode()
-                self.assertEqual(original_content, actual_content)
-
-                with self.assertRaises(SandboxCommandError):
-                    sandbox.run_command(['touch', added_filename], check=True)
-
-                with self.assertRaises(SandboxCommandError):
-                    sandbox.run_command(
-                        ['bash', '-c',
-                         "printf '{}' > {}".format(overwrite_content, added_filename)],
-                        check=True)
-
-                actual_content = sandbox.run_command(
-                    ['cat', added_filename], check=True
-                ).stdout.read().decode()
-                self.assertEqual(original_content, actual_content)
-
-                root_touch_result = sandbox.run_command(
-                    ['touch', added_filename], check=True, as_root=True)
-                self.assertEqual(0, root_touch_result.return_code)
-
-                sandbox.run_command(
-                    ['bash', '-c', "printf '{}' > {}".format(overwrite_content, added_filename)],
-                    as_root=True, check=True)
-                actual_content = sandbox.run_command(
-                    ['cat', added_filename]
-                ).stdout.read().decode()
-                self.assertEqual(overwrite_content, actual_content)
+            self.sandbox.add_files(f.name, owner='root', read_only=True)
+
+            # Try to modify the file as the unprivileged user, printing
+            # the exit status of each attempt followed by the file's
+            # contents.
+            result = self.sandbox.run_command(
+                ['bash', '-c',
+                 'touch "$0"; echo $?; printf "%s" "$1" > "$0"; echo $?; cat "$0"',
+                 added_filename, overwrite_content])
+            touch_status, write_status, actual_content = (
+                result.stdout.read().decode().split('\n', 2))
+            self.assertNotEqual('0', touch_status)
+            self.assertNotEqual('0', write_status)
+            self.assertEqual(original_content, actual_content)
+
+            result = self.sandbox.run_command(
+                ['bash', '-c', 'touch "$0" && printf "%s" "$1" > "$0" && cat "$0"',
+                 added_filename, overwrite_content],
+                as_root=True, check=True)
+            self.assertEqual(overwrite_content, result.stdout.read().decode())
 
     def test_overwrite_non_read_only_file(self) -> None:
         original_content = "some stuff"
@@ -942,77 +1073,88 @@ class AutograderSandboxCopyFilesTestCase(unittest.TestCase):
 
             added_filename = os.path.basename(f.name)
 
-            with AutograderSandbox() as sandbox:
-                sandbox.add_files(f.name)
+            self.sandbox.add_files(f.name)
 
-                actual_content = sandbox.run_command(
-                    ['cat', added_filename], check=True
-                ).stdout.read().decode()
-                self.assertEqual(original_content, actual_content)
+            actual_content = self.sandbox.run_command(
+                ['cat', added_filename], check=True
+            ).stdout.read().decode()
+            self.assertEqual(original_content, actual_content)
 
-                sandbox.run_command(
-                    ['bash', '-c', "printf '{}' > {}".format(overwrite_content, added_filename)])
-                actual_content = sandbox.run_command(
-                    ['cat', added_filename], check=True
-                ).stdout.read().decode()
-                self.assertEqual(overwrite_content, actual_content)
+            actual_content = self.sandbox.run_command(
+                ['bash', '-c', 'printf "%s" "$1" > "$0" && cat "$0"',
+                 added_filename, overwrite_content],
+                check=True
+            ).stdout.read().decode()
+            self.assertEqual(overwrite_content, actual_content)
 
     def test_error_add_files_invalid_owner(self) -> None:
-        with AutograderSandbox() as sandbox:
-            with self.assertRaises(ValueError):
-                sandbox.add_files('steve', owner='not_an_owner')
+        with self.assertRaises(ValueError):
+            self.sandbox.add_files('steve', owner='not_an_owner')
+
+
+# The image that the images built by OverrideCmdAndEntrypointTestCase
+# are based on.
+_OVERRIDE_TEST_BASE_IMAGE = 'jameslp/autograder-sandbox:3.1.2'
 
 
 class OverrideCmdAndEntrypointTestCase(unittest.TestCase):
+    # If the image's CMD or ENTRYPOINT weren't overridden, they would be
+    # PID 1 instead of bash (and the container would stop once they
+    # exit). Checking PID 1 directly means we don't have to wait and see
+    # whether the container stops.
+    def _assert_container_running_bash(self, sandbox: AutograderSandbox) -> None:
+        result = sandbox.run_command(['cat', '/proc/1/cmdline'], as_root=True, check=True)
+        self.assertEqual(b'/bin/bash\0', result.stdout.read())
+
     def test_override_image_cmd(self) -> None:
-        dockerfile = """FROM jameslp/autograder-sandbox:3.1.2
+        dockerfile = """FROM {}
 CMD ["echo", "goodbye"]
-"""
-        tag = 'sandbox_test_image_with_cmd'
-        with tempfile.TemporaryDirectory() as temp_dir:
-            with open(os.path.join(temp_dir, 'Dockerfile'), 'w') as f:
-                f.write(dockerfile)
-            subprocess.run('docker build -t {} {}'.format(tag, temp_dir), check=True, shell=True)
+""".format(_OVERRIDE_TEST_BASE_IMAGE)
+        tag = _build_image(dockerfile)
 
         with AutograderSandbox(docker_image=tag) as sandbox:
-            time.sleep(2)
+            self._assert_container_running_bash(sandbox)
             result = sandbox.run_command(['echo', 'hello'])
             self.assertEqual(0, result.return_code)
             self.assertEqual('hello\n', result.stdout.read().decode())
 
     def test_override_image_entrypoint(self) -> None:
-        dockerfile = """FROM jameslp/autograder-sandbox:3.1.2
+        dockerfile = """FROM {}
 ENTRYPOINT ["echo", "goodbye"]
-"""
-        tag = 'sandbox_test_image_with_entrypoint'
-        with tempfile.TemporaryDirectory() as temp_dir:
-            with open(os.path.join(temp_dir, 'Dockerfile'), 'w') as f:
-                f.write(dockerfile)
-            subprocess.run('docker build -t {} {}'.format(tag, temp_dir), check=True, shell=True)
+""".format(_OVERRIDE_TEST_BASE_IMAGE)
+        tag = _build_image(dockerfile)
 
         with AutograderSandbox(docker_image=tag) as sandbox:
-            time.sleep(2)
+            self._assert_container_running_bash(sandbox)
             result = sandbox.run_command(['echo', 'hello'])
             self.assertEqual(0, result.return_code)
             self.assertEqual('hello\n', result.stdout.read().decode())
 
     def test_override_image_cmd_and_entrypoint(self) -> None:
-        dockerfile = """FROM jameslp/autograder-sandbox:3.1.2
+        dockerfile = """FROM {}
 ENTRYPOINT ["echo", "goodbye"]
 CMD ["echo", "goodbye"]
-"""
-        tag = 'sandbox_test_image_with_cmd_and_entrypoint'
-        with tempfile.TemporaryDirectory() as temp_dir:
-            with open(os.path.join(temp_dir, 'Dockerfile'), 'w') as f:
-                f.write(dockerfile)
-            subprocess.run('docker build -t {} {}'.format(tag, temp_dir), check=True, shell=True)
+""".format(_OVERRIDE_TEST_BASE_IMAGE)
+        tag = _build_image(dockerfile)
 
         with AutograderSandbox(docker_image=tag) as sandbox:
-            time.sleep(2)
+            self._assert_container_running_bash(sandbox)
             result = sandbox.run_command(['echo', 'hello'])
             self.assertEqual(0, result.return_code)
             self.assertEqual('hello\n', result.stdout.read().decode())
 
 
+# Builds an image from the given Dockerfile contents and returns its tag.
+# The tag is derived from the Dockerfile, so each distinct Dockerfile is
+# only built once per test run.
+@functools.lru_cache(maxsize=None)
+def _build_image(dockerfile: str) -> str:
+    tag = 'sandbox_test_image_' + hashlib.sha1(dockerfile.encode()).hexdigest()[:12]
+    # The Dockerfile doesn't COPY anything, so we pass it on stdin
+    # rather than writing it to a build context directory.
+    subprocess.run(['docker', 'build', '-t', tag, '-'], input=dockerfile.encode(), check=True)
+    return tag
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,20 @@
+from typing import List
+
+import pytest
+
+
+# Tests that start many containers at once or put heavy memory or disk
+# pressure on the host. When running the tests in parallel, these should
+# be run in a separate, serial pass (see "Running the tests" in README.md).
+_SERIAL_TESTS = {
+    'test_multiple_containers_dont_exceed_ulimits',
+    'test_memory_limit_no_oom_kill',
+    'test_very_large_io_no_truncate',
+    'test_truncate_very_large_io',
+}
+
+
+def pytest_collection_modifyitems(items: List[pytest.Item]) -> None:
+    for item in items:
+        if item.name in _SERIAL_TESTS:
+            item.add_marker(pytest.mark.serial)